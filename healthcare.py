@@ -1,34 +1,29 @@
 import streamlit as st
 from google import genai
 from google.genai import types
-from streamlit_mic_recorder import speech_to_text # External component for voice input
 import json 
 import re 
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # --- CUSTOM UI STYLING FUNCTION (LIGHT THEME WITH GREEN TEXT) ---
 
 def set_custom_ui_style():
-    """Injects custom CSS for a LIGHT theme with green primary text."""
+    """Injects the CSS the theme in .streamlit/config.toml cannot express."""
+    # Background, sidebar, text and primary colors come from the [theme] section
+    # of .streamlit/config.toml, which Streamlit applies once per connection.
+    # This <style> block still has to be re-emitted on every run: elements that
+    # a rerun does not redraw are removed from the page.
     st.markdown("""
     <style>
-    /* 1. Main Background: Light Theme (White/Faint Gray) */
-    .stApp {
-        background-color: #f0f2f6; /* Light gray/default background */
-        color: #008000; /* Darker Green for primary text readability */
-    }
-
-    /* 2. Sidebar Color */
-    .css-1d391kg, .css-1y4p8a {
-        background-color: #ffffff; /* White sidebar */
-        color: #008000; /* Darker green text for contrast */
-    }
-    
-    /* 3. Headers and Titles (Kept Clinical Blue for visual structure/branding) */
+    /* 1. Headers and Titles (Kept Clinical Blue for visual structure/branding) */
     h1, h2, h3, h4 {
         color: #00a8cc; /* Clinical Cyan Blue for emphasis */
     }
 
-    /* 4. Chat Messages (Assistant: Light background, User: Default/Light contrast) */
+    /* 2. Chat Messages (Assistant: Light background, User: Default/Light contrast) */
     .stChatMessage [data-testid="stChatMessageContent"] {
         background-color: #e0eaff; /* Very faint blue for assistant bubble */
         border-left: 5px solid #00a8cc; /* Clinical cyan border */
@@ -51,18 +46,14 @@ def set_custom_ui_style():
         background-color: #ffffff;
     }
 
-    /* 5. Primary Button (Clinical blue remains for action) */
-    [data-testid="baseButton-primary"] {
-        background-color: #00a8cc;
-        border-color: #00a8cc;
-        color: white !important;
-    }
-    [data-testid="baseButton-primary"]:hover {
+    /* 3. Primary Button hover (the theme's primaryColor sets the resting color) */
+    [data-testid="baseButton-primary"]:hover,
+    [data-testid="stBaseButton-primary"]:hover {
         background-color: #007c99;
         border-color: #007c99;
     }
 
-    /* 6. Info Boxes (Need bright contrast) */
+    /* 4. Info Boxes (Need bright contrast) */
     [data-testid="stAlert"] {
         background-color: #d1ecf1; /* Light cyan background for info */
         color: #0c5460; /* Dark text for alerts */
@@ -89,12 +80,59 @@ CRITICAL OUTPUT RULES:
 
 MODEL_NAME = 'gemini-2.5-flash'
 APP_TITLE = "🩺 HealthCare Companion (Dr.Drug Lord)"
+WELCOME_MESSAGE = "Welcome!⛑ I am your Dr Drug Lord. Ask me about your symptoms."
+CONTEXT_REQUIRED_MESSAGE = "*Context Required:* Please fill the form above so I can give you a specific solution."
+
+DISCLAIMER_HTML = """
+<div style="padding: 5px;">
+<h4 style="color: #FF7F7F; margin-top: 0;">⚠ SAFETY FIRST (DISCLAIMER)</h4>
+<p style="color: #008000;">I provide general information only. <b>I am not a doctor.</b> Always consult a professional.</p>
+</div>
+"""
+
+# Streaming redraw throttle: every markdown() call re-sends and re-parses the
+# whole accumulated text, so redraw on line breaks (paragraphs, bullets) at
+# most ~20 times per second, or once a long line has grown enough.
+STREAM_FLUSH_INTERVAL = 0.05 # Minimum seconds between line-break redraws
+STREAM_FLUSH_CHARS = 80 # Redraw mid-line once this many new characters arrive
+SMOOTH_STREAM = True # Split oversized stream chunks so they reveal progressively
+SMOOTH_STREAM_DELAY = 0.02 # Seconds between the pieces of a split chunk
+SMOOTH_STREAM_BUDGET = 0.2 # Most delay added to a whole reply
+
+# Medicine answers persist as pickles in Streamlit's disk cache. max_entries only
+# bounds the in-memory copy, so the disk cache grows with every distinct name, and
+# bumping the version orphans the old files rather than deleting them. Clear it
+# with `streamlit cache clear` when deploying a version bump.
+MEDICINE_CACHE_VERSION = "v1" # Bump to invalidate cached medicine answers
+MEDICINE_CACHE_MAX_ENTRIES = 512 # Bound on answers held in memory (disk copies are kept)
+MAX_MEDICINES_PER_REQUEST = 5 # Upper bound on concurrent lookups, to respect rate limits
+
+# Chat bubbles kept in session state; the Gemini chat object keeps its own context
+MAX_HISTORY_MESSAGES = 40
+HISTORY_COLLAPSED_NOTES = {
+    'English': "_(Earlier conversation collapsed.)_",
+    'Kannada': "_(ಹಿಂದಿನ ಸಂಭಾಷಣೆಯನ್ನು ಮರೆಮಾಡಲಾಗಿದೆ.)_",
+    'Hindi': "_(पिछली बातचीत संक्षिप्त कर दी गई है।)_",
+    'Telugu': "_(మునుపటి సంభాషణ కుదించబడింది.)_",
+}
+
+# Gemini chat history compaction: every turn re-sends the whole history, so once
+# it grows past the estimate below, older turns are replaced by a short summary.
+CHAT_COMPACT_TOKENS = 4000 # Estimated as len(text) // 4
+CHAT_KEEP_TURNS = 2 # Most recent user/model exchanges kept verbatim
+
+METRICS_WINDOW = 50 # Streaming turns kept for the ?debug=1 latency panel
 
 # --- CONFIGURATION CONSTANTS ---
 # We keep this for future complex logic but will check ALL inputs now.
-AGE_RANGES = ["0-12", "13-17", "18-45", "46-65", "65+"]
-GENDER_OPTIONS = ["Male", "Female", "Prefer Not to Say"]
-THERAPY_OPTIONS = ["Ayurvedic Suggestion", "General/Modern Wellness"] 
+AGE_RANGES = ("0-12", "13-17", "18-45", "46-65", "65+")
+GENDER_OPTIONS = ("Male", "Female", "Prefer Not to Say")
+THERAPY_OPTIONS = ("Ayurvedic Suggestion", "General/Modern Wellness") 
+
+# Option -> position lookups for restoring the context form defaults
+AGE_INDEX = {age: i for i, age in enumerate(AGE_RANGES)}
+GENDER_INDEX = {gender: i for i, gender in enumerate(GENDER_OPTIONS)}
+THERAPY_INDEX = {therapy: i for i, therapy in enumerate(THERAPY_OPTIONS)}
 
 LANGUAGE_MAP = {
     'English (Default)': 'English',
@@ -102,6 +140,42 @@ LANGUAGE_MAP = {
     'Hindi (हिन्दी)': 'Hindi',
     'Telugu (తెలుగు)': 'Telugu'
 }
+LANGUAGE_KEYS = tuple(LANGUAGE_MAP.keys()) # Selectbox options, built once
+
+# Greetings and acknowledgements are answered locally: no context form, no API call
+SMALLTALK_RE = re.compile(r"^\s*(hi|hello|hey|thanks|thank\s+you|bye|ok|okay)\s*[!.]*\s*$", re.IGNORECASE)
+SMALLTALK_CATEGORIES = {
+    'hi': 'greeting', 'hello': 'greeting', 'hey': 'greeting',
+    'thanks': 'thanks', 'thank you': 'thanks',
+    'bye': 'bye',
+    'ok': 'ack', 'okay': 'ack',
+}
+SMALLTALK_REPLIES = {
+    'English': {
+        'greeting': "Hello! 👋 Tell me about any symptom or health concern.",
+        'thanks': "You're welcome! Take care. 🌿",
+        'bye': "Goodbye! Stay healthy. 🩺",
+        'ack': "Okay! Ask me whenever you have a health question.",
+    },
+    'Kannada': {
+        'greeting': "ನಮಸ್ಕಾರ! 👋 ನಿಮ್ಮ ಯಾವುದೇ ರೋಗಲಕ್ಷಣ ಅಥವಾ ಆರೋಗ್ಯ ಸಮಸ್ಯೆಯ ಬಗ್ಗೆ ತಿಳಿಸಿ.",
+        'thanks': "ಸಂತೋಷ! ನಿಮ್ಮ ಆರೋಗ್ಯ ಕಾಪಾಡಿಕೊಳ್ಳಿ. 🌿",
+        'bye': "ಹೋಗಿ ಬನ್ನಿ! ಆರೋಗ್ಯವಾಗಿರಿ. 🩺",
+        'ack': "ಸರಿ! ಯಾವುದೇ ಆರೋಗ್ಯ ಪ್ರಶ್ನೆ ಇದ್ದರೆ ನನ್ನನ್ನು ಕೇಳಿ.",
+    },
+    'Hindi': {
+        'greeting': "नमस्ते! 👋 मुझे अपने किसी भी लक्षण या स्वास्थ्य समस्या के बारे में बताइए।",
+        'thanks': "आपका स्वागत है! अपना ध्यान रखें। 🌿",
+        'bye': "अलविदा! स्वस्थ रहें। 🩺",
+        'ack': "ठीक है! जब भी कोई स्वास्थ्य प्रश्न हो, मुझसे पूछें।",
+    },
+    'Telugu': {
+        'greeting': "నమస్కారం! 👋 మీ ఏదైనా లక్షణం లేదా ఆరోగ్య సమస్య గురించి చెప్పండి.",
+        'thanks': "సంతోషం! జాగ్రత్తగా ఉండండి. 🌿",
+        'bye': "వెళ్ళి రండి! ఆరోగ్యంగా ఉండండి. 🩺",
+        'ack': "సరే! ఏదైనా ఆరోగ్య ప్రశ్న ఉంటే నన్ను అడగండి.",
+    },
+}
 
 # --- STATE MANAGEMENT ---
 if 'asking_for_details' not in st.session_state:
@@ -115,54 +189,143 @@ if 'current_language' not in st.session_state:
 
 if 'show_prescription_form' not in st.session_state:
     st.session_state.show_prescription_form = False
-    
-if 'user_choice_therapy' not in st.session_state:
-    st.session_state.user_choice_therapy = THERAPY_OPTIONS[1]
+
+if 'stream_metrics' not in st.session_state:
+    st.session_state.stream_metrics = deque(maxlen=METRICS_WINDOW)
+
+# Kept outside the toggle's widget key: Streamlit drops widget state while the
+# context form hides the input area, which would switch voice off every time.
+if 'voice_enabled' not in st.session_state:
+    st.session_state.voice_enabled = False
 
 # --- 2. INITIALIZATION FUNCTIONS ---
 
-def get_gemini_client():
-    """Initializes, stores, and returns the persistent Gemini Client."""
-    if 'gemini_client' in st.session_state:
-        return st.session_state['gemini_client']
+def _warm_up_client(client):
+    """Opens the client's HTTPS connection with a cheap model metadata request."""
+    try:
+        client.models.get(model=MODEL_NAME)
+    except Exception:
+        pass # Best effort: real requests report their own errors
+
+@st.cache_resource(show_spinner=False)
+def _create_gemini_client(api_key):
+    """Creates the Gemini Client shared by every session in this process."""
+    client = genai.Client(api_key=api_key)
+    # Warm the connection pool in the background so the first message skips
+    # DNS/TLS setup. No chat message is sent: it would bill tokens and end up
+    # in the conversation history.
+    threading.Thread(target=_warm_up_client, args=(client,), daemon=True).start()
+    return client
 
+def get_gemini_client():
+    """Returns the shared Gemini Client, or None after reporting the error."""
     if "GEMINI_API_KEY" not in st.secrets:
         st.error("❌ API Key not found. Please set your GEMINI_API_KEY in .streamlit/secrets.toml.")
         return None
         
     try:
-        client = genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
-        st.session_state['gemini_client'] = client 
-        return client
+        return _create_gemini_client(st.secrets["GEMINI_API_KEY"])
     except Exception as e:
         st.error(f"❌ Error initializing Gemini Client: {e}")
         return None
 
+@st.cache_resource(show_spinner=False)
+def get_chat_config():
+    """Builds the chat GenerateContentConfig once per process."""
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_INSTRUCTION
+    )
+
 def reset_chat():
     """Resets the chat session state."""
     client = get_gemini_client() 
     if not client:
         return
 
-    config = types.GenerateContentConfig(
-        system_instruction=SYSTEM_INSTRUCTION
-    )
-    
-    st.session_state['gemini_chat'] = client.chats.create(model=MODEL_NAME, config=config)
+    st.session_state['gemini_chat'] = client.chats.create(model=MODEL_NAME, config=get_chat_config())
     
-    st.session_state.messages = [{"role": "assistant", "content": 
-        "Welcome!⛑ I am your Dr Drug Lord. Ask me about your symptoms."}]
+    st.session_state.messages = [{"role": "assistant", "content": WELCOME_MESSAGE}]
     
     st.session_state.asking_for_details = False 
+    st.session_state.pop('pending_symptom', None)
     st.session_state.user_details = {} 
     st.session_state.show_prescription_form = False
-    st.session_state.user_choice_therapy = THERAPY_OPTIONS[1] 
-    
-    st.rerun() 
+
+# --- HELPER FOR CHAT HISTORY ---
+
+def add_message(role, content):
+    """
+    Appends a chat message. Past MAX_HISTORY_MESSAGES, the oldest ones (after the welcome)
+    are collapsed into a single marker message.
+    """
+    messages = st.session_state.messages
+    messages.append({"role": role, "content": content})
+    if len(messages) > MAX_HISTORY_MESSAGES:
+        # The slice starts at index 1, so an existing marker is replaced rather than repeated
+        note = HISTORY_COLLAPSED_NOTES.get(st.session_state.current_language, HISTORY_COLLAPSED_NOTES['English'])
+        messages[1:len(messages) - MAX_HISTORY_MESSAGES + 2] = [
+            {"role": "assistant", "content": note}
+        ]
+
+def compact_chat_history(client):
+    """
+    Replaces older Gemini chat turns with a summary once the history passes CHAT_COMPACT_TOKENS.
+    """
+    history = st.session_state['gemini_chat'].get_history(curated=True)
+    history_chars = sum(len(part.text or "") for content in history for part in content.parts or [])
+    if history_chars // 4 <= CHAT_COMPACT_TOKENS:
+        return
+
+    # Keep the last CHAT_KEEP_TURNS exchanges, starting on a user turn
+    split = len(history) - CHAT_KEEP_TURNS * 2
+    while split > 0 and history[split].role != "user":
+        split -= 1
+    if split <= 0:
+        return
+    older, recent = history[:split], history[split:]
+
+    transcript = "\n".join(
+        f"{content.role}: {part.text}" for content in older for part in content.parts or [] if part.text
+    )
+    try:
+        summary = client.models.generate_content(
+            model=MODEL_NAME,
+            contents=(
+                "Summarize this health conversation in under 150 words. "
+                f"Keep the symptoms, the user's context and the advice given.\n\n{transcript}"
+            ),
+        ).text
+    except Exception:
+        return # Keep the full history; the turn itself can still go through
+    if not summary:
+        return
+
+    st.session_state['gemini_chat'] = client.chats.create(
+        model=MODEL_NAME,
+        config=get_chat_config(),
+        history=[
+            types.Content(role="user", parts=[types.Part(text=f"Summary of our conversation so far: {summary}")]),
+            types.Content(role="model", parts=[types.Part(text="Understood.")]),
+            *recent,
+        ],
+    )
+
+def record_stream_metrics(t_start, t_first, output_tokens, paused=0.0):
+    """
+    Stores time to first token (TTFT) and decode speed (tokens/s) of a streamed reply.
+    `paused` is time the app itself slept while smoothing, left out of decode time.
+    """
+    if t_first is None:
+        return
+    decode_time = time.monotonic() - t_first - paused
+    st.session_state.stream_metrics.append({
+        "ttft": t_first - t_start,
+        "tds": output_tokens / decode_time if decode_time > 0 else 0.0,
+    })
 
 # --- HELPER FUNCTION FOR AI RESPONSE (TEXT ONLY) ---
 
-def handle_final_response(base_prompt, is_medicine_request=False):
+def handle_final_response(base_prompt):
     """
     Handles the API call and streams the text response.
     """
@@ -172,21 +335,13 @@ def handle_final_response(base_prompt, is_medicine_request=False):
 
     target_lang = st.session_state.current_language
     
-    if is_medicine_request:
-        final_prompt = f"{base_prompt}\n\nOutput in *{target_lang}*. Keep it brief: Usage + Key Symptoms treated."
-    else:
-        final_prompt = (
-            f"{base_prompt}\n\n"
-            f"Constraint: Respond in {target_lang}. "
-            f"Keep it concise. Structure as: 1. Short Summary. 2. Bullet points for Solutions."
-        )
+    final_prompt = (
+        f"{base_prompt}\n\n"
+        f"Constraint: Respond in {target_lang}. "
+        f"Keep it concise. Structure as: 1. Short Summary. 2. Bullet points for Solutions."
+    )
 
-    display_content = base_prompt if not is_medicine_request else f"Requesting info for medicine: {base_prompt}"
-    
-    # Append user message only if it hasn't been appended by the form submit handler
-    if not (st.session_state.messages and st.session_state.messages[-1]["content"].startswith("Context provided:")):
-        st.session_state.messages.append({"role": "user", "content": display_content})
-    
+    # The user's bubble ("Context provided: ...") is appended by the form submit handler
     full_response = ""
     
     with st.chat_message("assistant"):
@@ -195,15 +350,71 @@ def handle_final_response(base_prompt, is_medicine_request=False):
         try:
             message_placeholder.markdown("Thinking... 🧠")
             
+            compact_chat_history(client)
+            t_start = time.monotonic() # After compaction: TTFT measures the streaming request only
             response_stream = st.session_state['gemini_chat'].send_message_stream(final_prompt) 
             
-            full_stream_response = ""
-            temp_streaming_placeholder = st.empty() 
+            # Collect chunks in a list and join only when drawing, instead of
+            # re-copying the growing string on every chunk.
+            stream_parts = []
+            stream_len = 0
+            # Finished paragraphs are drawn once into settled_box; only the
+            # paragraph still streaming is redrawn, so each redraw sends just
+            # the tail instead of the whole reply.
+            settled_box = tail_placeholder = None
+            settled_len = 0
+            last_flush_time = time.monotonic()
+            last_flush_len = 0
+            t_first = None
+            output_tokens = None
+            smooth_budget = SMOOTH_STREAM_BUDGET
+            paused = 0.0
             for chunk in response_stream:
-                full_stream_response += chunk.text
-                temp_streaming_placeholder.markdown(full_stream_response + "▌") 
-
-            temp_streaming_placeholder.empty()
+                chunk_text = chunk.text or "" # Chunks without text parts return None
+                if chunk.usage_metadata and chunk.usage_metadata.candidates_token_count:
+                    output_tokens = chunk.usage_metadata.candidates_token_count
+                pieces = [chunk_text]
+                piece_delay = 0.0
+                if SMOOTH_STREAM and smooth_budget > 0 and len(chunk_text) > STREAM_FLUSH_CHARS:
+                    # The API sometimes dumps a burst of text in one chunk; feed it
+                    # through the throttle one redraw's worth at a time.
+                    pieces = [chunk_text[i:i + STREAM_FLUSH_CHARS]
+                              for i in range(0, len(chunk_text), STREAM_FLUSH_CHARS)]
+                    piece_delay = min(SMOOTH_STREAM_DELAY, smooth_budget / (len(pieces) - 1))
+                    smooth_budget -= piece_delay * (len(pieces) - 1)
+                for n, piece in enumerate(pieces):
+                    if n:
+                        t_pause = time.monotonic()
+                        time.sleep(piece_delay)
+                        paused += time.monotonic() - t_pause
+                    stream_parts.append(piece)
+                    stream_len += len(piece)
+                    now = time.monotonic()
+                    if t_first is None and piece:
+                        t_first = now
+                    line_done = "\n" in piece
+                    # Draw the first text immediately: it is the readiness signal
+                    first_text = last_flush_len == 0 and stream_len > 0
+                    if (first_text
+                            or stream_len - last_flush_len >= STREAM_FLUSH_CHARS
+                            or (line_done and now - last_flush_time >= STREAM_FLUSH_INTERVAL)):
+                        if first_text:
+                            # Stream into the same placeholder, replacing "Thinking..."
+                            stream_box = message_placeholder.container()
+                            settled_box = stream_box.container()
+                            tail_placeholder = stream_box.empty()
+                        stream_text = "".join(stream_parts)
+                        boundary = stream_text.rfind("\n\n", settled_len)
+                        # Never settle inside an open ``` code block
+                        if boundary != -1 and stream_text.count("```", 0, boundary) % 2 == 0:
+                            settled_box.markdown(stream_text[settled_len:boundary])
+                            settled_len = boundary + 2
+                        tail_placeholder.markdown(stream_text[settled_len:] + "▌") 
+                        last_flush_time = now
+                        last_flush_len = stream_len
+
+            full_stream_response = "".join(stream_parts)
+            record_stream_metrics(t_start, t_first, output_tokens or stream_len // 4, paused)
 
             # Directly display the full response
             message_placeholder.markdown(full_stream_response)
@@ -213,10 +424,80 @@ def handle_final_response(base_prompt, is_medicine_request=False):
             full_response = f"An error occurred: {e}"
             message_placeholder.markdown(full_response)
 
-    st.session_state.messages.append({
-        "role": "assistant", 
-        "content": full_response
-    })
+    add_message("assistant", full_response)
+
+# --- HELPER FOR MEDICINE INFORMATION (CACHED) ---
+
+@st.cache_data(persist="disk", max_entries=MEDICINE_CACHE_MAX_ENTRIES, show_spinner=False)
+def fetch_medicine_info(_client, medicine_key, target_lang, cache_version):
+    """
+    Fetches general info for a medicine in one non-streaming call.
+    Cached on disk per (medicine, language, cache_version) and shared by all sessions.
+    """
+    prompt = (
+        f"Please explain the general usage, purpose, and common symptoms treated by the medicine: '{medicine_key}'. "
+        f"Provide a clear note on when it is typically used.\n\n"
+        f"Output in *{target_lang}*. Keep it brief: Usage + Key Symptoms treated."
+    )
+    response = _client.models.generate_content(model=MODEL_NAME, contents=prompt, config=get_chat_config())
+    if not response.text:
+        # Raise so an empty answer is not cached
+        raise ValueError("The model returned an empty response.")
+    return response.text
+
+def handle_medicine_request(medicine_input):
+    """
+    Shows general info for one or more comma-separated medicines.
+    Names are looked up concurrently, each served from the shared cache when possible.
+    """
+    client = get_gemini_client()
+    if not client:
+        return
+
+    target_lang = st.session_state.current_language
+    # Normalized key -> name as first typed; "Dolo  650 " and "dolo 650" are one lookup
+    medicines = {}
+    for name in medicine_input.split(","):
+        medicine_key = " ".join(name.lower().split())
+        if medicine_key:
+            medicines.setdefault(medicine_key, " ".join(name.split()))
+    if not medicines:
+        return
+    skipped = len(medicines) - MAX_MEDICINES_PER_REQUEST
+    medicine_keys = list(medicines)[:MAX_MEDICINES_PER_REQUEST]
+    medicine_names = [medicines[key] for key in medicine_keys]
+
+    def fetch(medicine_key):
+        try:
+            return fetch_medicine_info(client, medicine_key, target_lang, MEDICINE_CACHE_VERSION)
+        except Exception as e:
+            return f"An error occurred: {e}"
+
+    add_message("user", f"Requesting info for medicine: {', '.join(medicine_names)}")
+
+    with st.chat_message("assistant"):
+        with st.spinner("Thinking... 🧠"):
+            if len(medicine_keys) == 1:
+                answers = [fetch(medicine_keys[0])]
+            else:
+                # One thread per name: K lookups take about as long as the slowest one
+                with ThreadPoolExecutor(max_workers=len(medicine_keys)) as pool:
+                    answers = list(pool.map(fetch, medicine_keys))
+
+        if len(medicine_names) == 1:
+            full_response = answers[0]
+        else:
+            full_response = "\n\n".join(
+                f"### 💊 {name}\n\n{answer}" for name, answer in zip(medicine_names, answers)
+            )
+        if skipped > 0:
+            full_response += (
+                f"\n\n_(Only the first {MAX_MEDICINES_PER_REQUEST} medicines were looked up; "
+                f"{skipped} more skipped. Ask again for the rest.)_"
+            )
+        st.markdown(full_response)
+
+    add_message("assistant", full_response)
 
 # --- HELPER FOR CONTEXT FORM SUBMISSION ---
 
@@ -228,14 +509,8 @@ def handle_context_form_submit(user_gender, user_age, user_weight, user_therapy_
     st.session_state.user_details['therapy'] = user_therapy_choice
     st.session_state.asking_for_details = False 
 
-    # Find the original symptom/complaint from the conversation history
-    # Look for the last user message that is NOT a form submission confirmation
-    original_symptom = "General health enquiry."
-    for msg in reversed(st.session_state.messages):
-        if msg['role'] == 'user' and not msg['content'].startswith('Context provided:'):
-             original_symptom = msg['content']
-             break
-
+    # The original symptom/complaint is stored when the input opens the form
+    original_symptom = st.session_state.pop('pending_symptom', "General health enquiry.")
     
     # Construct the comprehensive prompt for the Gemini API
     prompt = (
@@ -249,47 +524,114 @@ def handle_context_form_submit(user_gender, user_age, user_weight, user_therapy_
     )
     
     # Remove the temporary 'Context Required' message
-    if st.session_state.messages[-1]["content"].startswith("*Context Required*"):
+    if st.session_state.messages[-1]["content"] == CONTEXT_REQUIRED_MESSAGE:
         st.session_state.messages.pop()
     
     # Append the user's action/prompt to the history
-    st.session_state.messages.append({"role": "user", "content": f"Context provided: {user_gender}, {user_age}, {user_weight}kg, {user_therapy_choice}. Proceed with advice for: {original_symptom}"})
+    add_message("user", f"Context provided: {user_gender}, {user_age}, {user_weight}kg, {user_therapy_choice}. Proceed with advice for: {original_symptom}")
 
     # Call the API handler
     handle_final_response(prompt)
     st.rerun()
 
-# --- 3. STREAMLIT APP UI ---
+# --- 3. RENDERING FRAGMENTS ---
+# Fragments rerun on their own when a widget inside them changes. The input
+# area and the sidebar are fragments, so typing, voice and settings no longer
+# re-execute the whole script (CSS, history, forms). The history has no
+# widgets of its own and only redraws on full-app reruns, so it is a plain
+# function.
+
+def render_history():
+    """Renders the stored chat history."""
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            # User text is plain input: st.text skips the markdown pipeline
+            if message["role"] == "user":
+                st.text(message["content"])
+            else:
+                st.markdown(message["content"])
+
+@st.fragment
+def render_input_area():
+    """Renders the voice and text inputs and opens the context form on submit."""
+    st.markdown("---")
+    
+    col1, col2 = st.columns([1, 4])
+    
+    with col1:
+        voice_text = None
+        # The mic component ships its own JS bundle, so only mount it on request
+        if st.toggle(
+            "🎤 Voice",
+            value=st.session_state.voice_enabled,
+            key="voice_open",
+            on_change=lambda: st.session_state.update(voice_enabled=st.session_state.voice_open)
+        ):
+            # Imported here so the component only loads when voice input is used
+            from streamlit_mic_recorder import speech_to_text # External component for voice input
+
+            # VOICE INPUT: Manual stop is active
+            voice_text = speech_to_text(
+                language='en', 
+                start_prompt="🎤 Speak", 
+                stop_prompt="🛑 Stop", 
+                just_once=True,
+                key='voice_input'
+            )
+    
+    with col2:
+        # MODIFIED: Input hint reflects the ability to take any symptom
+        text_input = st.chat_input("Ask about any symptom or health concern...")
 
-st.set_page_config(page_title=APP_TITLE, page_icon="🩺", layout="wide")
-st.title(APP_TITLE)
+    user_input = voice_text or text_input
 
-if 'gemini_chat' not in st.session_state:
-    reset_chat()
+    if user_input:
+        smalltalk = SMALLTALK_RE.match(user_input)
+        if smalltalk:
+            add_message("user", user_input)
+            category = SMALLTALK_CATEGORIES[" ".join(smalltalk.group(1).lower().split())]
+            replies = SMALLTALK_REPLIES.get(st.session_state.current_language, SMALLTALK_REPLIES['English'])
+            add_message("assistant", replies[category])
+            st.rerun()
 
-# --- SIDEBAR CONTROLS ---
+        # MODIFIED: Trigger the context form for ANY other user input
+        add_message("user", user_input)
+        st.session_state.pending_symptom = user_input
+        st.session_state.asking_for_details = True
+        add_message("assistant", CONTEXT_REQUIRED_MESSAGE)
+        # Full app rerun: history and the context form live outside this fragment
+        st.rerun()
 
-with st.sidebar:
+@st.fragment
+def render_sidebar():
+    """Renders the settings sidebar; its widgets rerun only this fragment."""
     st.header("⚙ Settings")
     
     # 1. LANGUAGE SELECTOR
     st.subheader("Select Reading Language")
     selected_lang_key = st.selectbox(
         "Choose the language for the answer:",
-        options=list(LANGUAGE_MAP.keys()),
+        options=LANGUAGE_KEYS,
         index=0
     )
-    st.session_state.current_language = LANGUAGE_MAP[selected_lang_key]
+    selected_language = LANGUAGE_MAP[selected_lang_key]
+    if selected_language != st.session_state.current_language:
+        st.session_state.current_language = selected_language
+        if st.session_state.show_prescription_form:
+            st.rerun() # The medicine form heading shows the language
     
     st.markdown("---")
     
     # 2. MEDICINE INFO BUTTON
     if st.button("💊💉 Get Medicine Info"):
         st.session_state.show_prescription_form = not st.session_state.show_prescription_form
+        st.rerun() # Full app rerun: the form lives in the main area
 
     st.markdown("---")
     
-    st.button("Clear Chat History", on_click=reset_chat, type="primary")
+    if st.button("Clear Chat History", type="primary"):
+        reset_chat()
+        st.rerun() # Full app rerun: history lives outside this fragment
     
     if st.session_state.user_details:
         st.markdown("---")
@@ -297,23 +639,38 @@ with st.sidebar:
         for k, v in st.session_state.user_details.items():
             st.caption(f"{k.capitalize()}: {v}")
 
+    # 3. STREAMING METRICS (open the app with ?debug=1)
+    if st.query_params.get("debug") == "1" and st.session_state.stream_metrics:
+        st.markdown("---")
+        with st.expander("📈 Streaming Metrics"):
+            metrics = st.session_state.stream_metrics
+            avg_ttft = sum(m["ttft"] for m in metrics) / len(metrics)
+            st.metric("Time to first token", f"{metrics[-1]['ttft']:.2f} s")
+            st.metric(f"Avg TTFT (last {len(metrics)})", f"{avg_ttft:.2f} s")
+            st.metric("Decode speed", f"{metrics[-1]['tds']:.0f} tok/s")
+
+# --- 4. STREAMLIT APP UI ---
+
+st.set_page_config(page_title=APP_TITLE, page_icon="🩺", layout="wide")
+st.title(APP_TITLE)
+
+if 'gemini_chat' not in st.session_state:
+    reset_chat()
+
+# --- SIDEBAR CONTROLS ---
+
+with st.sidebar:
+    render_sidebar()
+
 
 # --- MAIN CHAT AREA ---
 
 # Safety Disclaimer
 with st.container(border=True):
-    st.markdown(f"""
-    <div style="padding: 5px;">
-    <h4 style="color: #FF7F7F; margin-top: 0;">⚠ SAFETY FIRST (DISCLAIMER)</h4>
-    <p style="color: #008000;">I provide general information only. <b>I am not a doctor.</b> Always consult a professional.</p>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(DISCLAIMER_HTML, unsafe_allow_html=True)
 
 # Display Chat History
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        # All messages displayed directly
-        st.markdown(message["content"])
+render_history()
 
 # --- INTERACTIVE FORMS ---
 
@@ -321,18 +678,14 @@ for message in st.session_state.messages:
 if st.session_state.show_prescription_form:
     with st.form("medicine_info_form"):
         st.subheader(f"💊💉 Medicine Information ({st.session_state.current_language})")
-        st.info("Enter the medicine name to understand its general usage and common symptoms treated.")
+        st.info(f"Enter one or more medicine names (comma-separated, up to {MAX_MEDICINES_PER_REQUEST}) to understand their general usage and common symptoms treated.")
         
-        medicine_name = st.text_input("Enter Medicine Name (e.g., Dolo 650):")
+        medicine_name = st.text_input("Enter Medicine Name(s) (e.g., Dolo 650, Cetirizine):")
         
         med_submitted = st.form_submit_button("Get Information", type="secondary")
 
         if med_submitted and medicine_name:
-            med_prompt = (
-                f"Please explain the general usage, purpose, and common symptoms treated by the medicine: '{medicine_name}'. "
-                f"Provide a clear note on when it is typically used."
-            )
-            handle_final_response(med_prompt, is_medicine_request=True)
+            handle_medicine_request(medicine_name)
             st.session_state.show_prescription_form = False
             st.rerun()
 
@@ -342,7 +695,7 @@ if st.session_state.asking_for_details:
     initial_gender = st.session_state.user_details.get('gender', GENDER_OPTIONS[0])
     initial_age = st.session_state.user_details.get('age', AGE_RANGES[2])
     initial_weight = st.session_state.user_details.get('weight', 70)
-    initial_therapy_index = THERAPY_OPTIONS.index(st.session_state.user_details.get('therapy', THERAPY_OPTIONS[1])) if st.session_state.user_details.get('therapy') in THERAPY_OPTIONS else 1
+    initial_therapy_index = THERAPY_INDEX.get(st.session_state.user_details.get('therapy'), 1)
     
     with st.form("context_form"):
         st.subheader("📝 Context Required")
@@ -351,11 +704,9 @@ if st.session_state.asking_for_details:
         # Details Collection (Gender, Age, Weight)
         col_g, col_a, col_w = st.columns(3)
         with col_g:
-            gender_index = GENDER_OPTIONS.index(initial_gender) if initial_gender in GENDER_OPTIONS else 0
-            gender = st.radio("👤 Gender", GENDER_OPTIONS, index=gender_index, horizontal=True) 
+            gender = st.radio("👤 Gender", GENDER_OPTIONS, index=GENDER_INDEX.get(initial_gender, 0), horizontal=True) 
         with col_a:
-            age_index = AGE_RANGES.index(initial_age) if initial_age in AGE_RANGES else 2
-            age = st.selectbox("📅 Age Range", AGE_RANGES, index=age_index)
+            age = st.selectbox("📅 Age Range", AGE_RANGES, index=AGE_INDEX.get(initial_age, 2))
         with col_w:
             weight = st.number_input("⚖ Weight (kg)", 1, 300, initial_weight, key="context_weight_input")
         
@@ -380,33 +731,4 @@ if st.session_state.asking_for_details:
 # --- MAIN INPUT (Voice & Text) ---
 
 if not st.session_state.asking_for_details and not st.session_state.show_prescription_form:
-    st.markdown("---")
-    
-    col1, col2 = st.columns([1, 4])
-    
-    with col1:
-        # VOICE INPUT: Manual stop is active
-        voice_text = speech_to_text(
-            language='en', 
-            start_prompt="🎤 Speak", 
-            stop_prompt="🛑 Stop", 
-            just_once=True,
-            key='voice_input'
-        )
-    
-    with col2:
-        # MODIFIED: Input hint reflects the ability to take any symptom
-        text_input = st.chat_input("Ask about any symptom or health concern...")
-
-    user_input = voice_text or text_input
-
-    if user_input:
-        # MODIFIED: Trigger the context form for ANY user input
-        st.session_state.messages.append({"role": "user", "content": user_input})
-        st.session_state.asking_for_details = True
-        
-        with st.chat_message("assistant"):
-            msg = "*Context Required:* Please fill the form above so I can give you a specific solution."
-            st.session_state.messages.append({"role": "assistant", "content": msg})
-            st.markdown(msg)
-        st.rerun()
+    render_input_area()